@@ -2,8 +2,8 @@ from dotenv import load_dotenv
 import os
 import streamlit as st
 import pandas as pd
-from pdf_class import PDF_FOLDER, vectorstore
-from pdf_manager import PDFManager
+from pdf_class import init_logging, load_vectorstore
+from pdf_manager import PDFManager, list_pdfs
 from chat_class import PokerTutor
 
 st.set_page_config(
@@ -42,6 +42,9 @@ st.markdown(
 # Load .env variables
 load_dotenv()
 
+# Set up logging once for the app
+init_logging()
+
 # Set up 'OPENAI_API_KEY' in the .env file which contains the API key
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
@@ -64,6 +67,17 @@ def select_none_pdfs():
     for file_name in pdf_files:
         st.session_state.selected_pdfs[file_name] = False
 
+# Status table of pdfs, rebuilt only after a status change
+def status_table():
+    if st.session_state.get("status_table_version") != st.session_state.status_version:
+        if st.session_state.files:
+            # File hashes are only for detecting changed PDFs, so they are not shown
+            st.session_state.status_table = pd.DataFrame.from_dict(st.session_state.files, orient="index").drop(columns="file_hash", errors="ignore")
+        else:
+            st.session_state.status_table = pd.DataFrame()
+        st.session_state.status_table_version = st.session_state.status_version
+    return st.session_state.status_table
+
 # Set up a spinner for longer functions
 def spinner(progress, function):
     with st.spinner(progress):
@@ -73,29 +87,28 @@ def spinner(progress, function):
 # Process all documents with a progress bar
 def process_all_with_progress():
     
-    pdf_files = os.listdir(PDF_FOLDER)
-    # Get the selected pdfs
+    pdf_files = list_pdfs()
+    # Get the selected pdfs, already vectorized ones are skipped and not counted in the progress
     selected_pdfs = [pdf_file for pdf_file in pdf_files if st.session_state.selected_pdfs.get(pdf_file, True)]
+    selected_pdfs = pdf_manager.pending_files(selected_pdfs)
     
     # Set progress bar to zero
     progress = st.progress(0)
-    
     full = len(selected_pdfs)
 
-    for i, file_name in enumerate(selected_pdfs):
-        try:
-            # Step by step processing for each pdf
-            pdf_manager.load_and_store(file_name, pdf_loader)
-            pdf_manager.clean_and_store(file_name)
-            pdf_manager.chunk_and_store(file_name)
-            pdf_manager.annotate(file_name)
-            pdf_manager.vectorize_chunks(file_name)
-
-        except Exception as e:
-            st.error(f"Error processing {file_name}: {e}")
-            
+    def show_progress(done, file_name, error):
+        if error:
+            st.error(f"Error processing {file_name}: {error}")
         # Updating progress bar, first visually, and then with label
-        progress.progress((i + 1) / full, f"{file_name} ({i + 1} / {full})")
+        progress.progress(done / full, f"{file_name} ({done} / {full})")
+
+    # Processed pdfs are vectorized with batched embedding requests
+    # Batches are stored in the background while the next pdfs are processed
+    try:
+        pdf_manager.process_all(selected_pdfs, pdf_loader, show_progress)
+    
+    except Exception as e:
+        st.error(f"Error vectorizing documents: {e}")
 
     st.success("Process all documents done!")
 
@@ -118,11 +131,8 @@ if "setup_complete" not in st.session_state:
 if not st.session_state.setup_complete:
             
     # List files
-    pdf_files = os.listdir(PDF_FOLDER)
-    if st.session_state.file_status:
-        pdfs = pd.DataFrame.from_dict(st.session_state.file_status, orient="index")
-    else:
-        pdfs = pd.DataFrame()    
+    pdf_files = list_pdfs()
+    pdfs = status_table()
 
     # Side bar to Select PDFs
     with st.sidebar:
@@ -133,12 +143,12 @@ if not st.session_state.setup_complete:
         if "selected_pdfs" not in st.session_state:
             st.session_state.selected_pdfs = {}
             
-         # Keeping checkbox states
-        for file_name in pdf_files:
-            if file_name not in st.session_state.selected_pdfs:
-                # This checks and changes value if the PDF is already processed
-                is_processed = st.session_state.file_status.get(file_name, {}).get("vectorized", False)
-                st.session_state.selected_pdfs[file_name] = not is_processed
+        # Keeping checkbox states, new PDFs are selected unless already processed
+        files = st.session_state.files
+        new_pdfs = set(pdf_files) - st.session_state.selected_pdfs.keys()
+        st.session_state.selected_pdfs.update({
+            file_name: file_name not in files or not files[file_name]["vectorized"] for file_name in new_pdfs
+        })
                     
         col1, col2 = st.columns([1,1])
         
@@ -149,7 +159,7 @@ if not st.session_state.setup_complete:
                     
 
         for file_name in pdf_files:
-            is_processed = st.session_state.file_status.get(file_name, {}).get("vectorized", False)
+            is_processed = pdf_manager.current_status(file_name)["vectorized"]
             st.session_state.selected_pdfs[file_name] = st.checkbox(
                 file_name,
                 value=st.session_state.selected_pdfs[file_name],
@@ -162,8 +172,13 @@ if not st.session_state.setup_complete:
     st.subheader("Documents")
     st.dataframe(pdfs, height=250, use_container_width=True)
     
-    # Clear All button
-    st.button("Clear All", key="clear_all", on_click=pdf_manager.clear_all)   
+    # Clear All and Save Status buttons
+    col1, col2 = st.columns([1, 1])
+    
+    with col1:
+        st.button("Clear All", key="clear_all", on_click=pdf_manager.clear_all)   
+    with col2:
+        st.button("Save Status", key="save_status", on_click=pdf_manager.flush_status)
 
     # PDF selection
     col1, col2 = st.columns([3, 1])
@@ -172,7 +187,7 @@ if not st.session_state.setup_complete:
         selected_pdf = st.selectbox("Choose a pdf:", pdf_files if pdf_files else ["No pdfs"])
     
     # Loader selection
-    pdf_loaders = ["PyPDFLoader", "pdfplumber"]
+    pdf_loaders = ["PyPDFLoader", "pdfplumber", "pymupdf"]
     
     with col2:
         pdf_loader = st.selectbox("Select Loader:", pdf_loaders)
@@ -180,33 +195,31 @@ if not st.session_state.setup_complete:
     # PDF processing buttons
     if selected_pdf and selected_pdf != "No pdfs":
         
+        # Status is checked against the file, so a replaced PDF can be processed again
+        status = pdf_manager.current_status(selected_pdf)
         col1, col2, col3, col4, col5, col6 = st.columns([1, 1, 1, 1, 1, 2])
 
         col1.button("Load", key=f"load_{selected_pdf}", 
                     on_click=lambda: spinner("Loading", lambda: pdf_manager.load_and_store(selected_pdf, pdf_loader)), 
-                    disabled=st.session_state.file_status[selected_pdf]["loaded"]
+                    disabled=status["loaded"]
                     )
 
         col2.button("Clean", key=f"clean_{selected_pdf}", 
                     on_click=lambda: spinner("Cleaning", lambda: pdf_manager.clean_and_store(selected_pdf)), 
-                    disabled=not st.session_state.file_status[selected_pdf]["loaded"] or
-                    st.session_state.file_status[selected_pdf]["cleaned"]
+                    disabled=not status["loaded"] or status["cleaned"]
                     )
 
         col3.button("Chunk", key=f"chunk_{selected_pdf}", 
                     on_click=lambda: spinner("Chunking", lambda: pdf_manager.chunk_and_store(selected_pdf)), 
-                    disabled=not st.session_state.file_status[selected_pdf]["cleaned"] or
-                    st.session_state.file_status[selected_pdf]["chunked"])
+                    disabled=not status["cleaned"] or status["chunked"])
 
         col4.button("Annotate", key=f"annotate_{selected_pdf}", 
                     on_click=lambda: spinner("Annotating", lambda: pdf_manager.annotate(selected_pdf)), 
-                    disabled=not st.session_state.file_status[selected_pdf]["chunked"] or
-                    st.session_state.file_status[selected_pdf]["annotated"])
+                    disabled=not status["chunked"] or status["annotated"])
 
         col5.button("Vectorize", key=f"vectorize_{selected_pdf}", 
                     on_click=lambda: spinner("Cleaning", lambda: pdf_manager.vectorize_chunks(selected_pdf)), 
-                    disabled=not st.session_state.file_status[selected_pdf]["annotated"] or
-                    st.session_state.file_status[selected_pdf]["vectorized"])
+                    disabled=not status["annotated"] or status["vectorized"])
         
         col6.button("Process All Documents", key="process_all", 
                     on_click=lambda: process_all_with_progress()
@@ -274,7 +287,7 @@ if not st.session_state.setup_complete:
 if st.session_state.setup_complete:
     
     # Create Chat class
-    chat = PokerTutor(vectorstore, OPENAI_MODEL)
+    chat = PokerTutor(load_vectorstore(), OPENAI_MODEL)
     
     # Display chat history for current session
     chat.display_chat()
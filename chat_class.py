@@ -7,6 +7,7 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain.memory import ConversationBufferMemory
 from langchain.schema import HumanMessage, AIMessage, SystemMessage
 from textwrap import dedent
+from pdf_class import embed_query, VECTORSTORE_LOCK
 
 # Helper function, not related to Chat class
 def remove_path(filepath):
@@ -83,6 +84,15 @@ class PokerTutor:
                     AIMessage(content=f"Hello {name}! How can I assist you with your poker questions today?")
                 )
 
+        # History text is built once, then extended with every new message
+        if "history" not in st.session_state:
+            st.session_state.history = "\n\n".join(self.format_history(message) for message in st.session_state.memory.chat_memory.messages)
+
+    def add_message(self, message):
+        # Function for storing a message in memory and in the history text
+        st.session_state.memory.chat_memory.add_message(message)
+        st.session_state.history += "\n\n" + self.format_history(message)
+
     def create_prompt(self):
         # Default prompt template
         prompt_template = PromptTemplate.from_template("""
@@ -103,33 +113,40 @@ class PokerTutor:
     def retrieve_context(self, prompt):
         # Function for retrieval
         
-        # Retriever for tables
-        table_retriever = self.vectorstore.similarity_search_with_score(prompt, k=1, filter={"type": "table"})
-
         table_docs = []
         table_score_max = 0.40
-
-        print("\nRetrieved Tables")
-        for doc, score in table_retriever:
-            # Evaluating results
-            if score <= table_score_max:
-                doc.metadata["score"] = score 
-                print(doc.metadata)
-                table_docs.append(doc)
-
-        # Retriever for texts
-        text_retriever = self.vectorstore.similarity_search_with_score(prompt, k=3, filter={"type": "text"})
+        table_k = 1
 
         text_docs = []
         text_score_max = 0.50
+        text_k = 3
+
+        # One over-fetching search for both tables and texts, split by type afterwards
+        fetch_k = 8
+        query_embedding = embed_query(self.vectorstore.embeddings, prompt)
+        # The vectorstore may be changed by the store thread meanwhile, so searching holds the lock
+        with VECTORSTORE_LOCK:
+            retriever = self.vectorstore.similarity_search_with_score_by_vector(query_embedding, k=fetch_k)
+
+        for doc, score in retriever:
+            # Results are sorted by score, so stop when both types are filled
+            if len(table_docs) == table_k and len(text_docs) == text_k:
+                break
+            
+            doc_type = doc.metadata.get("type")
+            # Evaluating results, the stored document is copied before adding the score
+            if doc_type == "table" and score <= table_score_max and len(table_docs) < table_k:
+                table_docs.append(doc.model_copy(update={"metadata": {**doc.metadata, "score": score}}))
+            elif doc_type == "text" and score <= text_score_max and len(text_docs) < text_k:
+                text_docs.append(doc.model_copy(update={"metadata": {**doc.metadata, "score": score}}))
+
+        print("\nRetrieved Tables")
+        for doc in table_docs:
+            print(doc.metadata)
 
         print("\nRetrieved Text")
-        for doc, score in text_retriever:
-            # Evaluating results
-            if score <= text_score_max:
-                doc.metadata["score"] = score 
-                print(doc.metadata)
-                text_docs.append(doc)
+        for doc in text_docs:
+            print(doc.metadata)
 
         # Combine retrieved tables and texts
         retrieved_docs = table_docs + text_docs
@@ -164,7 +181,7 @@ class PokerTutor:
             return
 
         # Store user message in memory
-        st.session_state.memory.chat_memory.add_message(HumanMessage(content=prompt))
+        self.add_message(HumanMessage(content=prompt))
         
         with st.chat_message("user"):
             st.markdown(prompt)
@@ -172,9 +189,6 @@ class PokerTutor:
         # Retrieve context from vector store
         context = self.retrieve_context(prompt)
 
-        # Get history
-        history = "\n\n".join(self.format_history(message) for message in st.session_state.memory.chat_memory.messages)
-
         chain = (
             {"history": RunnablePassthrough(), "context": RunnablePassthrough(), "question": RunnablePassthrough()} 
             | self.prompt_template
@@ -184,10 +198,10 @@ class PokerTutor:
 
         # AI response
         with st.chat_message("assistant"):
-            response = st.write_stream(chain.stream({"history": history, "context": context, "question": prompt}))
+            response = st.write_stream(chain.stream({"history": st.session_state.history, "context": context, "question": prompt}))
 
         # Store AI response in memory
-        st.session_state.memory.chat_memory.add_message(AIMessage(content=response))
+        self.add_message(AIMessage(content=response))
 
         # Show context
         with st.expander("Retrieved Context"):
@@ -4,13 +4,27 @@ import re
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters.character import CharacterTextSplitter
 from langchain_openai.embeddings import OpenAIEmbeddings
-from langchain_text_splitters import TokenTextSplitter
-from langchain_chroma import Chroma
+from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_text_splitters import TokenTextSplitter, RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain.schema import Document
 import pdfplumber
+import pymupdf
+import faiss
 import pandas as pd
 import tiktoken
 import logging
+from logging.handlers import RotatingFileHandler
+import functools
+from types import MappingProxyType
+import hashlib
+import pickle
+import tempfile
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 
 # GLOBAL VARIABLES
 
@@ -25,11 +39,32 @@ os.makedirs(PDF_FOLDER, exist_ok=True)
 TABLE_FOLDER = os.getenv("TABLE_FOLDER")
 os.makedirs(TABLE_FOLDER, exist_ok=True)
 
-# Set up 'STATUS_FILE' in the .env file which keep records of current statuses
-STATUS_FILE = os.getenv("STATUS_FILE")
+# Set up 'STATUS_DB' in the .env file which keep records of current statuses
+STATUS_DB = os.getenv("STATUS_DB", "status.db")
+
+# Set up 'EMBEDDING_PROVIDER' in the .env file, local 'huggingface' models by default or 'openai'
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "huggingface")
+
+# Default embedding model of each provider
+DEFAULT_EMBEDDING_MODELS = {
+    "huggingface": "BAAI/bge-small-en-v1.5",
+    "openai": "text-embedding-ada-002"
+}
 
 # Set up 'EMBEDDING_MODEL' in the .env file which is the model used for embeddings
-EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL") or DEFAULT_EMBEDDING_MODELS.get(EMBEDDING_PROVIDER)
+
+# OpenAI models cannot be loaded locally, e.g. with an .env file of an older version
+if EMBEDDING_PROVIDER != "openai" and EMBEDDING_MODEL.startswith("text-embedding-"):
+    raise ValueError(
+        f"EMBEDDING_MODEL '{EMBEDDING_MODEL}' is an OpenAI model, set EMBEDDING_PROVIDER='openai' or use a local model"
+    )
+
+# Set up 'EMBEDDING_BACKEND' in the .env file for local models, 'onnx' by default or 'torch'
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+
+# Set up 'ONNX_MODEL_FILE' in the .env file to use another ONNX export, e.g. a quantized one
+ONNX_MODEL_FILE = os.getenv("ONNX_MODEL_FILE", "onnx/model.onnx")
 
 # Set up 'DB_DIR' in the .env file which is the directory for the database
 DB_DIR = os.getenv("DB_DIR")
@@ -37,23 +72,337 @@ DB_DIR = os.getenv("DB_DIR")
 # Set up 'LOG_FILE' in the .env file which defines the log file
 LOG_FILE = os.getenv("LOG_FILE")
 
-# Default logging configuration
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
+# Status of a new PDF, read-only template copied for every file
+DEFAULT_STATUS = MappingProxyType({
+    "loaded": False,
+    "cleaned": False,
+    "chunked": False,
+    "annotated": False,
+    "vectorized": False
+})
 
-def load_vectorstore():
+# Maximum number of documents in one embedding request
+EMBEDDING_BATCH_SIZE = 256
+
+# Maximum number of tokens in one embedding request (OpenAI limit)
+EMBEDDING_MAX_TOKENS = 300000
+
+# Number of texts embedded together by a local model
+LOCAL_EMBEDDING_BATCH_SIZE = 64
+
+# Maximum number of characters in one local embedding batch, limits memory use
+LOCAL_EMBEDDING_MAX_CHARS = 150000
+
+# Maximum number of batches waiting for the store thread, the other documents stay on disk
+MAX_PENDING_BATCHES = 2
+
+# Chunk size and overlap in tokens of the embedding model
+CHUNK_SIZE = 512
+CHUNK_OVERLAP = 128
+
+# Tokenizer of the embedding model, created once when first needed
+# Page extraction workers import this module too, but never load the tokenizer
+@functools.lru_cache(maxsize=None)
+def load_tokenizer():
+    if EMBEDDING_PROVIDER == "openai":
+        # OpenAI tiktoken tokenizer
+        return tiktoken.encoding_for_model(EMBEDDING_MODEL)
+    
+    # Tokenizer of the local model, transformers is imported only when needed
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+
+# Token-based splitter, created once and reused for every PDF
+@functools.lru_cache(maxsize=None)
+def load_token_splitter():
+    tokenizer = load_tokenizer()
+    if EMBEDDING_PROVIDER == "openai":
+        return TokenTextSplitter(
+            encoding_name = tokenizer.name, 
+            chunk_size = CHUNK_SIZE, 
+            chunk_overlap = CHUNK_OVERLAP
+        )
+    
+    # Two tokens are left for the special tokens of the local model
+    return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+        tokenizer,
+        chunk_size = min(CHUNK_SIZE, tokenizer.model_max_length - 2), 
+        chunk_overlap = CHUNK_OVERLAP
+    )
+
+# Above this number of vectors the exact index is replaced by an HNSW index
+HNSW_THRESHOLD = 100000
+
+# HNSW index settings: neighbours per node, and search depth when building and searching
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# Number of worker processes for parallel PDF processing
+PROCESS_WORKERS = min(os.cpu_count() or 1, 4)
+
+# Number of pages processed together by one worker process
+PAGE_RANGE_SIZE = 8
+
+# Minimum number of pages for parallel extraction, starting worker processes takes seconds
+PARALLEL_PAGE_THRESHOLD = 100
+
+# Compiled patterns for cleaning the text
+HYPHEN_RE = re.compile(r'(\w+)-\s+(\w+)')
+WHITESPACE_RE = re.compile(rb'\s+')
+
+# Translation table for UTF-8 bytes, every non-ASCII byte becomes a space
+ASCII_TABLE = bytes(c if c < 0x80 else 0x20 for c in range(256))
+
+# Maximum size of the log file before it is rotated
+LOG_MAX_BYTES = 10 * 1024 * 1024
+
+# Format of the log messages
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+def init_logging():
+    # Default logging configuration of the app, called on every rerun
+    # Nothing happens if logging is already configured, so the log file is opened only once
+    if logging.getLogger().handlers:
+        return
+    
+    logging.basicConfig(
+        level=logging.INFO,
+        format=LOG_FORMAT,
+        handlers=[
+            RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=3),
+            logging.StreamHandler()
+        ]
+    )
+
+def init_worker_logging():
+    # Logging configuration of worker processes, only the app process rotates the log file
+    logging.basicConfig(
+        level=logging.INFO,
+        format=LOG_FORMAT,
+        handlers=[
+            logging.FileHandler(LOG_FILE),
+            logging.StreamHandler()
+        ]
+    )
+
+def load_embeddings():
+    # Function for loading the embedding model
+    if EMBEDDING_PROVIDER == "openai":
+        return OpenAIEmbeddings(model=EMBEDDING_MODEL, chunk_size=EMBEDDING_BATCH_SIZE)
+    
+    # Local model, no API requests needed
+    # ONNX Runtime is faster on CPU than torch, the export is created on first use if missing
+    model_kwargs = {}
+    if EMBEDDING_BACKEND == "onnx":
+        model_kwargs = {
+            "backend": "onnx",
+            "model_kwargs": {"file_name": ONNX_MODEL_FILE}
+        }
+    
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL,
+        model_kwargs=model_kwargs,
+        encode_kwargs={"normalize_embeddings": True, "batch_size": LOCAL_EMBEDDING_BATCH_SIZE}
+    )
+
+# Lock for the shared vectorstore, held while it is created, searched or changed
+# FAISS indexes are not thread-safe, and all sessions use the same vectorstore
+VECTORSTORE_LOCK = threading.RLock()
+
+# Loading the vectorstore database only once, when first needed
+# Worker processes import this module too, but they never load the database
+@functools.lru_cache(maxsize=None)
+def open_vectorstore():
     # Function for loading vectorstore
-    embedding = OpenAIEmbeddings(model=EMBEDDING_MODEL)
-    return Chroma(persist_directory=DB_DIR, embedding_function=embedding)
+    embedding = load_embeddings()
+    
+    if os.path.exists(os.path.join(DB_DIR, "index.faiss")):
+        # Index files are written only by this application
+        vectorstore = FAISS.load_local(DB_DIR, embedding, allow_dangerous_deserialization=True)
+        if isinstance(vectorstore.index, faiss.IndexHNSWFlat):
+            vectorstore.index.hnsw.efSearch = HNSW_EF_SEARCH
+        return vectorstore
+    
+    # New exact index, the dimension is taken from the embedding model
+    # L2 distance keeps the same scores as before (Chroma default)
+    index = faiss.IndexFlatL2(len(embedding.embed_query("poker")))
+    return FAISS(embedding_function=embedding, index=index, docstore=InMemoryDocstore(), index_to_docstore_id={})
+
+def load_vectorstore():
+    # Sessions starting together must not create two vectorstores
+    with VECTORSTORE_LOCK:
+        return open_vectorstore()
+
+# Query embeddings are cached per embeddings instance, so repeated questions are not embedded again
+# Keyed by id, as the embeddings models are not hashable, the instance is kept so the id stays unique
+QUERY_EMBEDDERS = {}
+
+def embed_query(embeddings, query):
+    # Function for embedding a question, the cache key ignores case and surrounding spaces
+    if id(embeddings) not in QUERY_EMBEDDERS:
+        cached = functools.lru_cache(maxsize=1024)(lambda text: tuple(embeddings.embed_query(text)))
+        QUERY_EMBEDDERS[id(embeddings)] = (embeddings, cached)
+    _, cached = QUERY_EMBEDDERS[id(embeddings)]
+    return list(cached(query.strip().lower()))
+
+# Background thread for storing into vectorstore, so storing overlaps with PDF processing
+# One thread only, as the FAISS index must not be written by two threads at once
+# Every change of the vectorstore, also saving and resetting, runs on this thread
+STORE_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+def upgrade_index(vectorstore):
+    # Function for replacing the exact index with HNSW when the corpus grows
+    # HNSW search is sub-linear, the vectors and their order stay the same
+    index = vectorstore.index
+    if not isinstance(index, faiss.IndexFlat) or index.ntotal <= HNSW_THRESHOLD:
+        return
+    
+    hnsw_index = faiss.IndexHNSWFlat(index.d, HNSW_M)
+    hnsw_index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    hnsw_index.hnsw.efSearch = HNSW_EF_SEARCH
+    hnsw_index.add(index.reconstruct_n(0, index.ntotal))
+    vectorstore.index = hnsw_index
+    logging.info("Vectorstore index upgraded to HNSW with %s vectors.", hnsw_index.ntotal)
+
+def persist_vectorstore(vectorstore):
+    # Function for persisting vectorstore to disk, faiss.write_index is used by save_local
+    with VECTORSTORE_LOCK:
+        upgrade_index(vectorstore)
+        vectorstore.save_local(DB_DIR)
+
+def save_vectorstore():
+    # Function for persisting the loaded vectorstore to disk
+    persist_vectorstore(load_vectorstore())
+
+def reset_vectorstore():
+    # Function for removing all documents from vectorstore
+    vectorstore = load_vectorstore()
+    with VECTORSTORE_LOCK:
+        vectorstore.index = faiss.IndexFlatL2(vectorstore.index.d)
+        vectorstore.docstore = InMemoryDocstore()
+        vectorstore.index_to_docstore_id = {}
+        persist_vectorstore(vectorstore)
+
+def document_size(doc):
+    # OpenAI requests are limited by tokens, local batches only by characters, which are cheaper to count
+    if EMBEDDING_PROVIDER == "openai":
+        return len(load_tokenizer().encode(doc.page_content))
+    return len(doc.page_content)
+
+def batch_documents(documents):
+    # Split documents into batches which fit into one embedding request
+    max_size = EMBEDDING_MAX_TOKENS if EMBEDDING_PROVIDER == "openai" else LOCAL_EMBEDDING_MAX_CHARS
+    batch = []
+    batch_size = 0
+
+    for doc in documents:
+        doc_size = document_size(doc)
+        
+        if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_size + doc_size > max_size):
+            yield batch
+            batch = []
+            batch_size = 0
+            
+        batch.append(doc)
+        batch_size += doc_size
+
+    if batch:
+        yield batch
 
-# Loading the vectorstore database
-vectorstore = load_vectorstore()
+def document_id(doc):
+    # Deterministic id from the source and content of a document
+    content = f"{doc.metadata.get('source')}\n{doc.page_content}"
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+def add_batch(vectorstore, batch):
+    # Storing a batch of documents, skipping the ones already in the vectorstore
+    # Ids are content hashes, so storing the same document again does nothing
+    # Stored ids are looked up in the docstore, ids of this batch in a small set
+    stored_docs = vectorstore.docstore._dict
+    batch_ids = set()
+    new_texts = []
+    new_metadatas = []
+    new_ids = []
+    
+    for doc in batch:
+        doc_id = document_id(doc)
+        if doc_id not in stored_docs and doc_id not in batch_ids:
+            doc.metadata["content_hash"] = doc_id
+            batch_ids.add(doc_id)
+            new_texts.append(doc.page_content)
+            new_metadatas.append(doc.metadata)
+            new_ids.append(doc_id)
+    
+    # Texts are embedded without the lock, so searches wait only while the index is changed
+    # Texts are added directly with their ids, no random ids are generated
+    if new_texts:
+        embeddings = vectorstore.embeddings.embed_documents(new_texts)
+        with VECTORSTORE_LOCK:
+            vectorstore.add_embeddings(zip(new_texts, embeddings), metadatas=new_metadatas, ids=new_ids)
+    
+    logging.info("Stored %s documents, skipped %s already stored.", len(new_texts), len(batch) - len(new_texts))
+
+def remove_source(vectorstore, source):
+    # Removing all documents of one PDF from the vectorstore, used when the PDF has changed
+    try:
+        ids = [doc_id for doc_id, doc in vectorstore.docstore._dict.items() if doc.metadata.get("source") == source]
+        if not ids:
+            return
+        
+        with VECTORSTORE_LOCK:
+            # HNSW cannot remove vectors, so the exact index is restored, and upgraded again when persisted
+            index = vectorstore.index
+            if isinstance(index, faiss.IndexHNSWFlat):
+                flat_index = faiss.IndexFlatL2(index.d)
+                flat_index.add(index.reconstruct_n(0, index.ntotal))
+                vectorstore.index = flat_index
+            
+            vectorstore.delete(ids)
+            persist_vectorstore(vectorstore)
+        logging.info("Removed %s documents of %s.", len(ids), source)
+    
+    except Exception as e:
+        logging.error("Error removing documents of %s: %s", source, e)
+
+def store_documents(vectorstore, documents):
+    # Storing documents in batches and persisting the vectorstore
+    for batch in batch_documents(documents):
+        add_batch(vectorstore, batch)
+    persist_vectorstore(vectorstore)
+
+def remove_spill(spill_path):
+    # Removing written documents, the file may already be gone
+    try:
+        os.remove(spill_path)
+    except FileNotFoundError:
+        pass
+
+# Helper functions for cleaning and chunking
+
+def file_hash(path):
+    # Hash of the file bytes, read in blocks
+    digest = hashlib.blake2b()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def clean_page(page):
+    # This is fixing hyphenated words
+    text = HYPHEN_RE.sub(r'\1\2', page.page_content)
+    # This removes special characters
+    text = text.encode('utf-8', 'surrogatepass').translate(ASCII_TABLE)
+    # This removes \n characters and repeated spaces
+    page.page_content = WHITESPACE_RE.sub(b' ', text).strip().decode('ascii')
+    return page
+
+def split_pages(splitter, pages):
+    # Splitting page by page, so each page can be released after splitting
+    chunks = []
+    for page in pages:
+        chunks.extend(splitter.split_documents([page]))
+    return chunks
 
 # Helper functions for extracting tables
 
@@ -63,12 +412,10 @@ def clean_table(table_df):
     table_df = table_df.dropna(axis=1, how='all')
 
     # Convert to string and remove if only None values
-    for column in table_df.columns:
-        if all(str(value).strip() == 'None' for value in table_df[column]):
-            table_df = table_df.drop(columns=[column])
-
+    none_columns = table_df.astype(str).apply(lambda column: column.str.strip()).eq('None').all(axis=0)
+    
     # Reset index
-    table_df = table_df.reset_index(drop=True)
+    table_df = table_df.loc[:, ~none_columns].reset_index(drop=True)
 
     # First row as header
     if len(table_df) > 1:
@@ -114,6 +461,39 @@ def tables_to_markdown(pdf_page):
     
     return "\n".join(tables_md) if tables_md else None
 
+def extract_page(pdf_page):
+    # Get the text with table placeholders and the markdown tables of a page
+    page_text = tables_as_placeholder(pdf_page)
+    page_tables = tables_to_markdown(pdf_page)
+    # Release the cached page objects
+    pdf_page.close()
+    return page_text, page_tables
+
+def extract_page_range(pdf_path, start, stop):
+    # Extracting a range of pages, runs in a worker process
+    # pdfplumber pages cannot be pickled, so the worker opens the PDF itself
+    with pdfplumber.open(pdf_path) as pdf:
+        return [extract_page(pdf.pages[i]) for i in range(start, stop)]
+
+def pymupdf_extract_page(pdf_page):
+    # Get the text with table placeholders and the markdown tables of a PyMuPDF page
+    page_text = pdf_page.get_text("text")
+    tables_md = []
+    
+    for table_num, table in enumerate(pdf_page.find_tables().tables, start=1):
+        # Extract table text
+        table_text = pdf_page.get_text("text", clip=table.bbox)
+        if table_text:
+            page_text = page_text.replace(table_text, f"[TABLE {table_num}]")
+        
+        table_df = pd.DataFrame(table.extract())
+        if not table_df.empty:
+            # Clean the table and convert to markdown
+            table_df = clean_table(table_df)
+            tables_md.append(table_df.to_markdown(index=False))
+    
+    return page_text, "\n".join(tables_md) if tables_md else None
+
 
 # PDF class definition
 class PDF:
@@ -122,16 +502,12 @@ class PDF:
         self._file_name = file_name
         self._embedding_model = embedding_model
         self._vectorstore = vectorstore
-        self._status = {
-            "loaded": False,
-            "cleaned": False,
-            "chunked": False,
-            "annotated": False,
-            "vectorized": False
-        }
+        self._status = DEFAULT_STATUS.copy()
         self.pages = []
         self.tables = []
         self.chunks = []
+        self._store_future = None
+        self.spill_path = None
 
     # Property functions for getting values from protected attributes
     @property
@@ -149,70 +525,99 @@ class PDF:
     def update_status(self, new_status):
         self._status = new_status
                 
-    def load(self, pdf_loader = 'PyPDFLoader'):
-        # Function for loading the PDF file
-        try:
-            if pdf_loader == 'PyPDFLoader':
-                # Load with PyPDFLoader
-                self.log("PDF load with PyPDFLoader")
-                loader = PyPDFLoader(self.pdf_path)
-                
-                for page in loader.load():
-                    page.metadata["type"] = "text"
-                    self.pages.append(page)                
-                
-            elif pdf_loader == 'pdfplumber':                
-                # Load with pdfplumber - complex method
-                self.log("PDF load with pdfplumber")
-                
-                with pdfplumber.open(self.pdf_path) as pdf:
-                    
-                    for i, page in enumerate(pdf.pages):
-                        # Get the text from the page and put placeholders for tables
-                        page_text = tables_as_placeholder(page)
-                        
-                        if page_text:
-                            
-                            self.pages.append(Document(
-                                page_content=page_text,
-                                metadata={
-                                    "page": i,
-                                    "page_label": i + 1,
-                                    "source": self.pdf_path,
-                                    "type": "text"
-                                }
-                            ))
+    def iter_plumber_pages(self, page_workers = 1):
+        # Generator for extracting text and tables with pdfplumber, in page order
+        with pdfplumber.open(self.pdf_path) as pdf:
+            page_count = len(pdf.pages)
+            
+            if page_workers <= 1 or page_count < PARALLEL_PAGE_THRESHOLD:
+                for page in pdf.pages:
+                    yield extract_page(page)
+                return
+        
+        # Large PDF: page ranges are extracted in parallel worker processes
+        starts = range(0, page_count, PAGE_RANGE_SIZE)
+        stops = [min(start + PAGE_RANGE_SIZE, page_count) for start in starts]
+        
+        with ProcessPoolExecutor(max_workers=page_workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker_logging) as executor:
+            for page_range in executor.map(extract_page_range, repeat(self.pdf_path), starts, stops):
+                yield from page_range
+    
+    def iter_pymupdf_pages(self):
+        # Generator for extracting text and tables with PyMuPDF, in page order
+        with pymupdf.open(self.pdf_path) as pdf:
+            for page in pdf:
+                yield pymupdf_extract_page(page)
+    
+    def iter_pages(self, pdf_loader = 'PyPDFLoader', page_workers = 1):
+        # Generator for reading the PDF file one page at a time
+        if pdf_loader == 'PyPDFLoader':
+            # Load with PyPDFLoader
+            self.log("PDF load with PyPDFLoader")
+            loader = PyPDFLoader(self.pdf_path)
+            
+            for page in loader.lazy_load():
+                page.metadata["type"] = "text"
+                yield page
+            
+        elif pdf_loader in ('pdfplumber', 'pymupdf'):                
+            # Load with pdfplumber or PyMuPDF - complex method with tables
+            self.log(f"PDF load with {pdf_loader}")
+            text_pages = 0
+            
+            if pdf_loader == 'pdfplumber':
+                extracted_pages = self.iter_plumber_pages(page_workers)
+            else:
+                extracted_pages = self.iter_pymupdf_pages()
+            
+            # Text from the pages with placeholders for tables, and tables in markdown format
+            for i, (page_text, page_tables) in enumerate(extracted_pages):
+                 
+                if page_tables:
                         
-                        # Get the tables from the page and convert to markdown format
-                        page_tables = tables_to_markdown(page)
-                         
-                        if page_tables:
-                                
-                            name = self.file_name.rstrip(".pdf")
-                            txt_file = os.path.join(TABLE_FOLDER, f"{name}_page_{i+1}_table.txt")
-                            
-                            # Write the tables into the file
-                            with open(txt_file, "w", encoding="utf-8") as f:
-                                f.write(page_tables)
-                            
-                            self.tables.append(Document(
-                                page_content=page_tables,
-                                metadata={
-                                    "page": i,
-                                    "page_label": i + 1,
-                                    "source": self.pdf_path,
-                                    "type": "table"
-                                }
-                            ))
+                    name = self.file_name.rstrip(".pdf")
+                    txt_file = os.path.join(TABLE_FOLDER, f"{name}_page_{i+1}_table.txt")
+                    
+                    # Write the tables into the file
+                    with open(txt_file, "w", encoding="utf-8") as f:
+                        f.write(page_tables)
                     
-                    print(f"Extracted {len(self.pages)} text pages and {len(self.tables)} tables.")                        
+                    self.tables.append(Document(
+                        page_content=page_tables,
+                        metadata={
+                            "page": i,
+                            "page_label": i + 1,
+                            "source": self.pdf_path,
+                            "type": "table"
+                        }
+                    ))
                 
+                if page_text:
+                    text_pages += 1
+                    yield Document(
+                        page_content=page_text,
+                        metadata={
+                            "page": i,
+                            "page_label": i + 1,
+                            "source": self.pdf_path,
+                            "type": "text"
+                        }
+                    )
+            
+            print(f"Extracted {text_pages} text pages and {len(self.tables)} tables.")                        
+                
+    def load(self, pdf_loader = 'PyPDFLoader', page_workers = PROCESS_WORKERS):
+        # Function for loading the PDF file
+        try:
+            # Hash of the read content, so a replaced PDF is noticed later
+            self._status["file_hash"] = file_hash(self.pdf_path)
+            self.pages.extend(self.iter_pages(pdf_loader, page_workers))
                                  
             self._status["loaded"] = True
             self.log("PDF load done!")
             
         except Exception as e:
-            logging.error(f"Error with loading the PDF: {e}")
+            logging.error("Error with loading the PDF: %s", e)
             return
     
     def clean(self):
@@ -222,18 +627,13 @@ class PDF:
         
         try:
             for page in self.pages:
-                # This is fixing hyphenated words
-                page.page_content = re.sub(r'(\w+)-\s+(\w+)', r'\1\2', page.page_content)
-                # This removes \n characters
-                page.page_content = ' '.join(page.page_content.split())
-                # This removes special characters
-                page.page_content = re.sub(r'[^\x00-\x7F]+', ' ', page.page_content)
+                clean_page(page)
 
             self._status["cleaned"] = True
             self.log(f"PDF cleaning done!")
             
         except Exception as e:
-            logging.error(f"Error with cleaning the PDF: {e}")
+            logging.error("Error with cleaning the PDF: %s", e)
             return
                     
     
@@ -247,37 +647,48 @@ class PDF:
             if chunk_type == 'char':
                 chunk_size = 2048
                 chunk_overlap = 300    
-                char_splitter = CharacterTextSplitter(
+                splitter = CharacterTextSplitter(
                     separator = ". ", 
                     chunk_size = chunk_size, 
                     chunk_overlap = chunk_overlap
                 )
-                self.chunks = char_splitter.split_documents(self.pages)
                 
             # Token-based chunking - that is the default
             elif chunk_type == 'token':
-                chunk_size = 512
-                chunk_overlap = 128
-                
-                # OpenAI tiktoken tokenizer
-                token_encoding = tiktoken.encoding_for_model(EMBEDDING_MODEL).name
-                    
-                token_splitter = TokenTextSplitter(
-                    encoding_name = token_encoding, 
-                    chunk_size = chunk_size, 
-                    chunk_overlap = chunk_overlap
-                )
-                self.chunks = token_splitter.split_documents(self.pages)
+                splitter = load_token_splitter()
                 
             else:
                 raise ValueError(f"Choose correct chunk type: char or token based approach")
             
+            self.chunks = split_pages(splitter, self.pages)
+            # Pages are not needed after chunking
+            self.pages = []
+            
             self._status["chunked"] = True
             self.log(f"PDF chunked into {len(self.chunks)} chunks!")
             
         except Exception as e:
-            logging.error(f"Error with chunking the PDF: {e}")
+            logging.error("Error with chunking the PDF: %s", e)
             return        
+    
+    def process(self, pdf_loader = 'PyPDFLoader'):
+        # Function for loading, cleaning and chunking in one pass
+        # Pages are streamed, so only one page is kept in memory at a time
+        # Pages are read in this process, as it already runs in a worker process
+        try:
+            # Hash of the read content, so a replaced PDF is noticed later
+            self._status["file_hash"] = file_hash(self.pdf_path)
+            pages = (clean_page(page) for page in self.iter_pages(pdf_loader))
+            self.chunks = split_pages(load_token_splitter(), pages)
+            
+            self._status["loaded"] = True
+            self._status["cleaned"] = True
+            self._status["chunked"] = True
+            self.log(f"PDF processed into {len(self.chunks)} chunks!")
+            
+        except Exception as e:
+            logging.error("Error with processing the PDF: %s", e)
+            return
         
     def annotate(self):
         # Function for annotation
@@ -288,25 +699,68 @@ class PDF:
             self._status["annotated"] = True
             self.log("PDF annotated!")
     
-    def vectorize(self):
-        # Function for store into vectorstore
+    def documents(self):
+        # Function for getting all documents to be stored
         if not self._status["annotated"]:
             raise ValueError("Please load, clean, chunk and annotate the PDF before vectorizing.")            
         
+        # Documents written to disk after processing are read back only now
+        if self.spill_path:
+            with open(self.spill_path, "rb") as f:
+                return pickle.load(f)
+        
+        return self.chunks + self.tables
+    
+    def spill(self, spill_folder):
+        # Function for writing the documents to disk, so they are not kept in memory until vectorizing
+        # Every file gets a unique name in the private folder of the manager
+        fd, self.spill_path = tempfile.mkstemp(suffix=".documents.pkl", dir=spill_folder)
+        
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(self.chunks + self.tables, f, protocol=5)
+        
+        self.chunks = []
+        self.tables = []
+    
+    def vectorize(self):
+        # Function for store into vectorstore, storing runs in the background
+        documents = self.documents()
+        
+        print("\nDocuments to be stored in Vectorstore")
+        for doc in documents:
+            print(doc.metadata)            
+        
+        self._store_future = STORE_EXECUTOR.submit(store_documents, self._vectorstore, documents)
+    
+    def wait_for_vectorize(self):
+        # Function for waiting until the background storing is done
         try:
-            documents = self.chunks + self.tables
-            print("\nDocuments to be stored in Vectorstore")
-            for doc in documents:
-                print(doc.metadata)            
-            
-            self._vectorstore.add_documents(documents)
-            
-            self._status["vectorized"] = True
-            self.log("PDF vectorized and stored!")
+            self._store_future.result()
+            self.mark_vectorized()
             
         except Exception as e:
-            logging.error(f"Error with vectorizing and storing the PDF: {e}")
+            logging.error("Error with vectorizing and storing the PDF: %s", e)
             return         
+    
+    def mark_vectorized(self):
+        # Function for marking the PDF as stored, also used by batched vectorizing
+        self._status["vectorized"] = True
+        self.log("PDF vectorized and stored!")
+        
+        # Written documents are not needed anymore
+        if self.spill_path:
+            remove_spill(self.spill_path)
+            self.spill_path = None
             
     def log(self, message):
-        logging.info(f"[{self._file_name}] {message}")        
\ No newline at end of file
+        logging.info("[%s] %s", self._file_name, message)
+
+
+def parse_clean_chunk(file_name, pdf_loader, spill_folder):
+    # Processing one PDF without vectorizing, runs in a worker process
+    # Vectorstore is not needed here, documents are written to disk until vectorizing
+    pdf = PDF(file_name, EMBEDDING_MODEL, None)
+    pdf.process(pdf_loader)
+    pdf.annotate()
+    pdf.spill(spill_folder)
+    return pdf.spill_path, pdf.status
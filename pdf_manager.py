@@ -1,152 +1,438 @@
 import os
+import shutil
+import tempfile
 import streamlit as st
 import json
+import sqlite3
 import logging
-from pdf_class import PDF, EMBEDDING_MODEL, STATUS_FILE, PDF_FOLDER, TABLE_FOLDER, LOG_FILE, vectorstore
-
-# Default logging configuration
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
-
-# Helper function, not related to PDF managing
-def load_status():
+import atexit
+import threading
+import queue
+import time
+from collections import defaultdict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+from pdf_class import PDF, DEFAULT_STATUS, EMBEDDING_MODEL, STATUS_DB, PDF_FOLDER, TABLE_FOLDER, load_vectorstore, save_vectorstore, reset_vectorstore, batch_documents, add_batch, EMBEDDING_BATCH_SIZE, MAX_PENDING_BATCHES, STORE_EXECUTOR, file_hash, remove_source, remove_spill, PROCESS_WORKERS, init_worker_logging, parse_clean_chunk
+
+# Faster JSON library if installed, otherwise standard json is used
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Helper functions, not related to PDF managing
+def status_from_json(data):
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def status_to_json(status):
+    if orjson:
+        return orjson.dumps(status).decode("utf-8")
+    return json.dumps(status)
+
+def connect_status_db():
+    # Status is stored per PDF, so saving one PDF does not rewrite the others
+    # WAL mode lets other sessions read while status is written
+    conn = sqlite3.connect(STATUS_DB, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS status (file_name TEXT PRIMARY KEY, status TEXT NOT NULL)")
+    return conn
+
+def write_status(conn, statuses):
+    # Writing status of several PDFs in one transaction
+    conn.execute("BEGIN")
     try:
-        if os.path.exists(STATUS_FILE):
-            with open(STATUS_FILE, "r") as file:
-                return json.load(file)    
+        conn.executemany(
+            "INSERT OR REPLACE INTO status VALUES (?, ?)",
+            [(file_name, status_to_json(status)) for file_name, status in statuses.items()]
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+@st.cache_data(show_spinner=False)
+def scan_pdfs(folder, folder_mtime):
+    with os.scandir(folder) as entries:
+        return [entry.name for entry in entries if entry.is_file()]
+
+def list_pdfs():
+    # List of pdfs, cached until the folder changes
+    return scan_pdfs(PDF_FOLDER, os.stat(PDF_FOLDER).st_mtime_ns)
+
+@st.cache_data(show_spinner=False)
+def hash_pdf(file_name, file_mtime, file_size):
+    return file_hash(os.path.join(PDF_FOLDER, file_name))
+
+def pdf_hash(file_name):
+    # Hash of the pdf bytes, computed again only when the file changes
+    stat = os.stat(os.path.join(PDF_FOLDER, file_name))
+    return hash_pdf(file_name, stat.st_mtime_ns, stat.st_size)
+
+def status_writer():
+    # Background thread writing queued status updates, so saving does not block the app
+    # Updates arriving within one interval are written together, the latest per PDF
+    conn = None
+    while True:
+        updates = [STATUS_QUEUE.get()]
+        time.sleep(STATUS_WRITE_INTERVAL)
+        while not STATUS_QUEUE.empty():
+            updates.append(STATUS_QUEUE.get())
+        
+        clear = False
+        statuses = {}
+        for file_name, status in updates:
+            # Clearing drops the updates queued before it
+            if file_name is None:
+                clear = True
+                statuses = {}
+            else:
+                statuses[file_name] = status
+        
+        try:
+            if conn is None:
+                conn = connect_status_db()
+            if clear:
+                conn.execute("DELETE FROM status")
+            if statuses:
+                write_status(conn, statuses)
+        
+        except Exception as e:
+            logging.error("Error saving status: %s", e)
+        
+        finally:
+            for _ in updates:
+                STATUS_QUEUE.task_done()
+
+def load_status(conn):
+    # Status files of older versions are not imported, their PDFs are not in the FAISS index
+    try:
+        return {file_name: status_from_json(data) for file_name, data in conn.execute("SELECT file_name, status FROM status")}
+    
     except Exception as e:
-        logging.error(f"Error with status file loading: {e}")
-    return {} 
+        logging.error("Error with status loading: %s", e)
+    return {}
+
+
+# Status updates waiting for the writer thread, as (file_name, status), file_name None clears all
+STATUS_QUEUE = queue.Queue()
+
+# Seconds the writer thread collects status updates before writing them
+STATUS_WRITE_INTERVAL = 0.5
+
+# Writer thread, started when the first status is queued, so importing this module starts no thread
+STATUS_WRITER = None
+STATUS_WRITER_LOCK = threading.Lock()
+
+def start_status_writer():
+    # Function for starting the status writer thread once, sessions may queue status at the same time
+    global STATUS_WRITER
+    with STATUS_WRITER_LOCK:
+        if STATUS_WRITER is None:
+            STATUS_WRITER = threading.Thread(target=status_writer, name="status_writer", daemon=True)
+            STATUS_WRITER.start()
+            # Queued status is written before the app exits
+            atexit.register(STATUS_QUEUE.join)
 
 
 # PDFManager class definition
 class PDFManager:
     def __init__(self):
         
-        # Load status file
-        saved_status = load_status()
-        
-        if "file_status" not in st.session_state:
-            st.session_state.file_status = saved_status
-        if "pages" not in st.session_state:
-            st.session_state.pages = {}
-        if "tables" not in st.session_state:
-            st.session_state.tables = {}            
-        if "chunks" not in st.session_state:
-            st.session_state.chunks = {}
+        # Load status database
+        conn = connect_status_db()
+        saved_status = load_status(conn)
+        conn.close()
+        
+        # Status of every PDF, documents stay only in the cached PDF object, so they are released after vectorizing
+        if "files" not in st.session_state:
+            st.session_state.files = saved_status
+        if "status_version" not in st.session_state:
+            st.session_state.status_version = 0
             
-        # Store PDF objects    
-        self.files = {}
-        
-        # Initialization of session state for all pdf files
-        pdf_files = os.listdir(PDF_FOLDER)
-        for file_name in pdf_files:
-            if file_name not in st.session_state.file_status:
-                st.session_state.file_status[file_name] = {
-                    "loaded": False,
-                    "cleaned": False,
-                    "chunked": False,
-                    "annotated": False,
-                    "vectorized": False
-                }
+        # Lock per PDF for the pipeline stages
+        self._locks = defaultdict(threading.Lock)
+        # Private folder for documents of processed PDFs waiting for vectorizing
+        self._spill_folder = tempfile.mkdtemp(prefix="poker_tutor_")
+        atexit.register(shutil.rmtree, self._spill_folder, ignore_errors=True)
+        
+        files = st.session_state.files
+        pdf_files = set(list_pdfs())
+        
+        # Store PDF objects, a slot for every pdf is made at once
+        self.files = dict.fromkeys(pdf_files)
+        
+        # PDFs replaced with different content are processed again
+        for file_name in pdf_files & files.keys():
+            self.current_status(file_name)
+        
+        # Initialization of session state for all new pdf files
+        new_files = pdf_files - files.keys()
+        files.update({file_name: DEFAULT_STATUS.copy() for file_name in new_files})
     
     def get_pdf(self, file_name):
         # If found already in the cache, return the object
-        if file_name in self.files:
-            return self.files[file_name]
+        pdf = self.files.get(file_name)
+        if pdf is not None:
+            return pdf
         
         # If there is no pdf object, create and store it
-        pdf = PDF(file_name, EMBEDDING_MODEL, vectorstore)
+        pdf = PDF(file_name, EMBEDDING_MODEL, load_vectorstore())
         self.files[file_name] = pdf
         
         # If there is file status in session state, we update it
-        if file_name in st.session_state.file_status:
-            pdf.update_status(st.session_state.file_status[file_name])
+        status = st.session_state.files.get(file_name)
+        if status is not None:
+            pdf.update_status(status)
         
         return pdf
     
     
+    def current_status(self, file_name):
+        # Status of a PDF, reset if the file was replaced with different content
+        # The hash is cached on file time and size, so checking at every stage is cheap
+        files = st.session_state.files
+        status = files.get(file_name)
+        if status is None:
+            status = files[file_name] = DEFAULT_STATUS.copy()
+        
+        saved_hash = status.get("file_hash")
+        if saved_hash and saved_hash != pdf_hash(file_name):
+            logging.info("PDF %s has changed, status is reset.", file_name)
+            status = files[file_name] = DEFAULT_STATUS.copy()
+            # The cached PDF object holds the old content
+            self.files[file_name] = None
+            # Documents of the old content are removed before the PDF is vectorized again
+            STORE_EXECUTOR.submit(remove_source, load_vectorstore(), os.path.join(PDF_FOLDER, file_name))
+            self.status_changed()
+        
+        return status
+    
+    def status_changed(self):
+        # Counting status changes, so the app rebuilds its status table only when needed
+        st.session_state.status_version += 1
+    
     def load_and_store(self, file_name, pdf_loader):
         # PDF processing and storing into session state
-        pdf = self.get_pdf(file_name)
-        pdf.load(pdf_loader)
-        st.session_state.pages[file_name] = pdf.pages
-        st.session_state.tables[file_name] = pdf.tables
-        st.session_state.file_status[file_name]["loaded"] = True
+        # Lock per PDF, so an overlapping rerun does not run the same stage again
+        with self._locks[file_name]:
+            status = self.current_status(file_name)
+            if status["loaded"]:
+                return
+            pdf = self.get_pdf(file_name)
+            pdf.load(pdf_loader)
+            status["loaded"] = True
+            self.status_changed()
         
     def clean_and_store(self, file_name):
-        pdf = self.get_pdf(file_name)
-        pdf.pages = st.session_state.pages[file_name]
-        pdf.clean()
-        st.session_state.pages[file_name] = pdf.pages
-        st.session_state.file_status[file_name]["cleaned"] = True
+        with self._locks[file_name]:
+            status = self.current_status(file_name)
+            if status["cleaned"]:
+                return
+            pdf = self.get_pdf(file_name)
+            pdf.clean()
+            status["cleaned"] = True
+            self.status_changed()
         
     def chunk_and_store(self, file_name):
-        pdf = self.get_pdf(file_name)
-        pdf.pages = st.session_state.pages[file_name]
-        pdf.chunk()
-        st.session_state.chunks[file_name] = pdf.chunks
-        st.session_state.file_status[file_name]["chunked"] = True
+        with self._locks[file_name]:
+            status = self.current_status(file_name)
+            if status["chunked"]:
+                return
+            pdf = self.get_pdf(file_name)
+            pdf.chunk()
+            status["chunked"] = True
+            self.status_changed()
+
+    def store_processed(self, file_name, spill_path, status):
+        # Storing results of a PDF processed in a worker process
+        # Documents stay on disk until vectorizing
+        # Returns False if the PDF was vectorized meanwhile, then its documents are not needed
+        with self._locks[file_name]:
+            file_status = self.current_status(file_name)
+            if file_status["vectorized"]:
+                remove_spill(spill_path)
+                return False
+            pdf = self.get_pdf(file_name)
+            pdf.spill_path = spill_path
+            file_status.update(status)
+            pdf.update_status(file_status)
+            self.status_changed()
+            return True
 
     def annotate(self, file_name):
-        pdf = self.get_pdf(file_name)
-        pdf.annotate()
-        st.session_state.file_status[file_name]["annotated"] = True
+        with self._locks[file_name]:
+            status = self.current_status(file_name)
+            if status["annotated"]:
+                return
+            pdf = self.get_pdf(file_name)
+            pdf.annotate()
+            status["annotated"] = True
+            self.status_changed()
         
     def vectorize_chunks(self, file_name):
-        pdf = self.get_pdf(file_name)
-        pdf.chunks = st.session_state.chunks[file_name]
-        pdf.vectorize()
-        st.session_state.file_status[file_name]["vectorized"] = True
-        # Save status after vectorization
-        self.save_status(file_name)
+        with self._locks[file_name]:
+            status = self.current_status(file_name)
+            # Embedding is the most expensive stage, so it must never run twice
+            if status["vectorized"]:
+                return
+            pdf = self.get_pdf(file_name)
+            pdf.vectorize()
+            pdf.wait_for_vectorize()
+            # The PDF is marked only after all its documents are stored, errors are logged
+            if not pdf.status["vectorized"]:
+                return
+            status["vectorized"] = True
+            self.status_changed()
+            # Save status after vectorization
+            self.save_status(file_name)
+    
+    def pending_files(self, file_names):
+        # PDFs not vectorized yet
+        return [file_name for file_name in file_names if not self.current_status(file_name)["vectorized"]]
+
+    def process_all(self, file_names, pdf_loader, on_progress=None):
+        # Full pipeline for several PDFs, vectorizing starts while the next PDFs are processed
+        # Already vectorized PDFs are skipped
+        self.vectorize_all(self.iter_processed(self.pending_files(file_names), pdf_loader, on_progress))
+
+    def iter_processed(self, file_names, pdf_loader, on_progress=None):
+        # Load, clean, chunk and annotate the PDFs in worker processes, yielding each processed PDF
+        # Processes are used, as PDF parsing and cleaning mostly hold the GIL
+        # Spawn is used, as Streamlit scripts and the vectorstore are not fork-safe
+        with ProcessPoolExecutor(max_workers=PROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker_logging) as executor:
+            futures = {executor.submit(parse_clean_chunk, file_name, pdf_loader, self._spill_folder): file_name for file_name in file_names}
+            
+            for done, future in enumerate(as_completed(futures), start=1):
+                file_name = futures[future]
+                error = None
+                stored = False
+                try:
+                    spill_path, status = future.result()
+                    stored = self.store_processed(file_name, spill_path, status)
+                
+                except Exception as e:
+                    logging.error("Error processing %s: %s", file_name, e)
+                    error = e
+                
+                if stored:
+                    yield file_name
+                
+                # Caller is told about every finished PDF, also the failed ones
+                if on_progress:
+                    on_progress(done, file_name, error)
+    
+    def vectorize_all(self, file_names):
+        # Vectorizing several PDFs together, so embedding requests are shared between them
+        # file_names can be a generator, full batches are stored in the background meanwhile
+        vectorstore = load_vectorstore()
+        queued_docs = []
+        # Position after the last document of each PDF
+        doc_ends = []
+        # Store futures with the position after their last document
+        futures = []
+        total = 0
+        submitted = 0
+        
+        for file_name in file_names:
+            # Documents of the next PDF are read only when storing has caught up
+            pending = [future for future, _ in futures if not future.done()]
+            if len(pending) > MAX_PENDING_BATCHES:
+                wait(pending[:len(pending) - MAX_PENDING_BATCHES])
+            
+            documents = self.get_pdf(file_name).documents()
+            queued_docs.extend(documents)
+            total += len(documents)
+            doc_ends.append((file_name, total))
+            
+            # Submit full batches, the rest waits for documents of the next PDFs
+            batches = list(batch_documents(queued_docs))
+            queued_docs = []
+            if batches and len(batches[-1]) < EMBEDDING_BATCH_SIZE:
+                queued_docs = batches.pop()
+            
+            for batch in batches:
+                submitted += len(batch)
+                futures.append((STORE_EXECUTOR.submit(add_batch, vectorstore, batch), submitted))
+        
+        for batch in batch_documents(queued_docs):
+            submitted += len(batch)
+            futures.append((STORE_EXECUTOR.submit(add_batch, vectorstore, batch), submitted))
+        
+        # Wait for all batches, count documents stored before the first failed batch
+        wait([future for future, _ in futures])
+        stored = 0
+        error = None
+        for future, batch_end in futures:
+            error = future.exception()
+            if error:
+                break
+            stored = batch_end
+        
+        # Saving runs on the store thread too, as the index must not be used by two threads at once
+        if futures:
+            STORE_EXECUTOR.submit(save_vectorstore).result()
+        
+        files = st.session_state.files
+        for file_name, doc_end in doc_ends:
+            # Only PDFs with all documents in the vectorstore are marked
+            if doc_end > stored:
+                break
+            
+            with self._locks[file_name]:
+                status = files[file_name]
+                # Vectorized meanwhile with the Vectorize button
+                if status["vectorized"]:
+                    continue
+                self.get_pdf(file_name).mark_vectorized()
+                status["vectorized"] = True
+                self.status_changed()
+                # Save status after vectorization, the writer thread writes all PDFs together
+                self.save_status(file_name)
+        
+        if error:
+            raise error
+        
+        logging.info("Vectorized %s documents from %s PDFs.", total, len(doc_ends))
     
        
     def save_status(self, file_name):
-        # Function for saving status into status file 
+        # Function for saving status of a vectorized PDF
         try:
-            if not st.session_state.file_status[file_name]["vectorized"]:
-                logging.error(f"PDF {file_name} is not vectorized!")
+            status = st.session_state.files[file_name]
+            if not status["vectorized"]:
+                logging.error("PDF %s is not vectorized!", file_name)
                 return
 
-            if os.path.exists(STATUS_FILE):
-                with open(STATUS_FILE, "r") as file:
-                    all_status = json.load(file)
-            else:
-                all_status = {}
-
-            all_status[file_name] = st.session_state.file_status[file_name]
-
-            with open(STATUS_FILE, "w") as file:
-                json.dump(all_status, file, indent=4)            
+            # Saved status is written by the status writer thread
+            start_status_writer()
+            STATUS_QUEUE.put((file_name, status.copy()))
             
         except Exception as e:
-            logging.error(f"Error saving status file: {e}")
+            logging.error("Error saving status: %s", e)
+    
+    def flush_status(self):
+        # Function for waiting until saved status is written into status database
+        STATUS_QUEUE.join()
     
           
     def clear_all(self):
         # Clear all status and new vectorstore
         try:
-            if os.path.exists(STATUS_FILE):
-                os.remove(STATUS_FILE)             
+            # Status saved before clearing is dropped, then the database is emptied
+            start_status_writer()
+            STATUS_QUEUE.put((None, None))
+            self.flush_status()
             
-            for file in os.listdir(TABLE_FOLDER):
-                file_path = os.path.join(TABLE_FOLDER, file)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
+            # Table folder only contains extracted tables, so it is recreated empty
+            shutil.rmtree(TABLE_FOLDER, ignore_errors=True)
+            os.makedirs(TABLE_FOLDER, exist_ok=True)
                     
-            vectorstore.reset_collection() 
+            STORE_EXECUTOR.submit(reset_vectorstore).result()
               
-            st.session_state.file_status = {}
-            st.session_state.pages = {}
-            st.session_state.chunks = {}
-            st.session_state.tables = {}
+            st.session_state.files = {}
+            self.status_changed()
             
             
             # We reinit PDFManager, and automatically store in session state
@@ -155,4 +441,4 @@ class PDFManager:
             logging.info("Cleared all documents.")
                       
         except Exception as e:
-            logging.error(f"Error with clearing: {e}")
\ No newline at end of file
+            logging.error("Error with clearing: %s", e)
\ No newline at end of file